@@ -0,0 +1,361 @@
+import gzip
+import http.client
+import io
+import json
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import version_bumper  # noqa: E402
+
+
+class FakeResponse(io.BytesIO):
+    """Response of the fake PyPI, with the parts of HTTPResponse we use."""
+
+    def __init__(
+        self,
+        status: int,
+        body: bytes = b"",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        super().__init__(body)
+        self.status = status
+        self.headers = {"Content-Length": str(len(body)), **(headers or {})}
+
+    def getheader(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.headers.get(name, default)
+
+    def isclosed(self) -> bool:
+        return self.tell() == len(self.getvalue())
+
+
+class FakeConnection:
+    """Connection to the fake PyPI, one per worker thread like the real ones."""
+
+    def __init__(self, pypi: "FakePyPI") -> None:
+        self.pypi = pypi
+        self.path = ""
+
+    def request(self, method: str, path: str, headers: Dict[str, str]) -> None:
+        self.pypi.requests.append((path, headers))
+        self.path = path
+
+    def getresponse(self) -> FakeResponse:
+        if self.pypi.error is not None:
+            raise self.pypi.error
+        status, body, headers = self.pypi.responses.get(self.path, (404, b"", {}))
+        return FakeResponse(status, body, headers)
+
+    def close(self) -> None:
+        self.pypi.closed += 1
+
+
+class FakePyPI:
+    """Stand-in for pypi.org, serving canned responses by request path."""
+
+    def __init__(self) -> None:
+        self.responses: Dict[str, Tuple[int, bytes, Dict[str, str]]] = {}
+        self.requests: List[Tuple[str, Dict[str, str]]] = []
+        self.error: Optional[Exception] = None
+        self.closed = 0
+
+    def add(
+        self,
+        package: str,
+        status: int,
+        body: bytes = b"",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.responses[f"/pypi/{package}/json"] = (status, body, headers or {})
+
+    def connection(self, *args, **kwargs) -> FakeConnection:
+        return FakeConnection(self)
+
+
+def package_json(version: str, padding: int = 0) -> bytes:
+    return json.dumps(
+        {"info": {"version": version}, "releases": {version: ["x" * padding]}},
+    ).encode()
+
+
+@pytest.fixture
+def pypi(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> FakePyPI:
+    """
+    Replace PyPI with a fake server and reset the lookup caches.
+
+    :param monkeypatch: pytest monkeypatch fixture.
+    :param tmp_path: directory for the ETag cache.
+    :yield: fake PyPI.
+    """
+    fake = FakePyPI()
+    monkeypatch.setattr(http.client, "HTTPSConnection", fake.connection)
+    monkeypatch.delenv("HTTPS_PROXY", raising=False)
+    monkeypatch.delenv("https_proxy", raising=False)
+    monkeypatch.setattr(
+        version_bumper,
+        "get_etag_cache_path",
+        lambda: tmp_path / "etags.json",
+    )
+    version_bumper.get_new_version.cache_clear()
+    version_bumper._ETAG_CACHE.clear()
+    version_bumper._LOCAL.conn = None
+    yield fake
+    version_bumper.get_new_version.cache_clear()
+    version_bumper._ETAG_CACHE.clear()
+    version_bumper._LOCAL.conn = None
+
+
+@pytest.mark.parametrize(
+    "line,expected",
+    [
+        ('requests = "^2.25.0"', ("requests", "2.25.0", 13, 19)),
+        ('requests = "~2.25"', ("requests", "2.25", 13, 17)),
+        ('requests = "<3.0"', ("requests", "3.0", 13, 16)),
+        ('requests = "2.25.0"', ("requests", "2.25.0", 12, 18)),
+        ('  requests = "^2.25.0"', ("requests", "2.25.0", 15, 21)),
+        (
+            'typer = {version = "^0.7.0", extras = ["all"]}',
+            ("typer", "0.7.0", 21, 26),
+        ),
+        (
+            'typer = {extras = ["all"], version = "^0.7.0"}',
+            ("typer", "0.7.0", 39, 44),
+        ),
+        (
+            'foo = {version = "^1.0", python_version = "3.8"}',
+            ("foo", "1.0", 19, 22),
+        ),
+        ('foo = {python_version = "3.8"}', None),
+        ('foo = "=1.2.3"', None),
+        ('foo = "==1.2.3"', None),
+        ('foo = {version = "=1.2.3"}', None),
+        ('foo = ">=1.10"', None),
+        ('foo = "!=1.0"', None),
+        ('foo = "<=2"', None),
+        ('foo = "*"', None),
+        ('foo = {git = "https://example.com/foo.git"}', None),
+        ("", None),
+    ],
+)
+def test_parse_dependency(
+    line: str,
+    expected: Optional[Tuple[str, str, int, int]],
+) -> None:
+    parsed = version_bumper.parse_dependency(line)
+    assert parsed == expected
+    if parsed is not None:
+        _, version, start, end = parsed
+        assert line[start:end] == version
+
+
+@pytest.mark.parametrize(
+    "version,new_version,expected",
+    [
+        ("1.0", "2.0", True),
+        ("1.10", "1.10.0", False),
+        ("2.0", "1.9", False),
+        ("2.0", "2.0", False),
+        ("2.*", "3.0", True),
+    ],
+)
+def test_is_newer(version: str, new_version: str, expected: bool) -> None:
+    assert version_bumper.is_newer(version, new_version) is expected
+
+
+def test_get_dependencies(tmp_path: Path) -> None:
+    pyproject = tmp_path / "pyproject.toml"
+    pyproject.write_text(
+        "[tool.poetry]\n"
+        'name = "x"\n'
+        "\n"
+        "[tool.poetry.dependencies]\n"
+        'python = "^3.8"\n'
+        'click = "^8.0"\n'
+        "{% if x %}\n"
+        'ünicode = "^1.0"\n'
+        "\n"
+        "[tool.poetry.dev-dependencies]\n"
+        'pytest = "^6.0"\n',
+        encoding="utf-8",
+    )
+    lines, deps = version_bumper.get_dependencies(
+        pyproject,
+        "tool.poetry.dependencies",
+    )
+    assert len(lines) == 11
+    assert deps == [(5, 'click = "^8.0"'), (7, 'ünicode = "^1.0"'), (8, "")]
+
+
+def test_get_new_version(pypi: FakePyPI) -> None:
+    pypi.add("pytest-env", 200, package_json("1.1.0"), {"ETag": '"a"'})
+
+    assert version_bumper.get_new_version("pytest_env") == "1.1.0"
+    path, headers = pypi.requests[0]
+    assert path == "/pypi/pytest-env/json"
+    assert headers["Accept-Encoding"] == "gzip"
+    assert "If-None-Match" not in headers
+    assert version_bumper._ETAG_CACHE == {
+        "pytest_env": {"etag": '"a"', "version": "1.1.0"},
+    }
+
+
+def test_get_new_version_gzip(pypi: FakePyPI) -> None:
+    pypi.add(
+        "click",
+        200,
+        gzip.compress(package_json("8.1.0")),
+        {"Content-Encoding": "gzip"},
+    )
+
+    assert version_bumper.get_new_version("click") == "8.1.0"
+
+
+def test_get_new_version_not_modified(pypi: FakePyPI) -> None:
+    version_bumper._ETAG_CACHE["click"] = {"etag": '"a"', "version": "8.1.0"}
+    pypi.add("click", 304)
+
+    assert version_bumper.get_new_version("click") == "8.1.0"
+    _, headers = pypi.requests[0]
+    assert headers["If-None-Match"] == '"a"'
+
+
+@pytest.mark.parametrize(
+    "status,body,headers",
+    [
+        (404, b"", {}),
+        (304, b"", {}),
+        (200, b"<html>oops</html>", {}),
+        (200, package_json("1.0")[:20], {}),
+        (200, b"{}", {}),
+        (200, b'{"info": {"version": null}}', {}),
+        (200, b"[]", {}),
+        (200, b"garbage", {"Content-Encoding": "gzip"}),
+    ],
+)
+def test_get_new_version_failure(
+    pypi: FakePyPI,
+    status: int,
+    body: bytes,
+    headers: Dict[str, str],
+) -> None:
+    pypi.add("click", status, body, headers)
+
+    assert version_bumper.get_new_version("click") is None
+    assert version_bumper._ETAG_CACHE == {}
+
+
+def test_get_new_version_network_error(pypi: FakePyPI) -> None:
+    pypi.error = TimeoutError("timed out")
+
+    assert version_bumper.get_new_version("click") is None
+    assert pypi.closed == 1
+
+
+def test_get_new_version_stream(
+    pypi: FakePyPI,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    pytest.importorskip("ijson")
+    monkeypatch.setattr(version_bumper, "STREAM_MIN_LENGTH", 0)
+    pypi.add("click", 200, package_json("8.1.0", padding=1024 * 1024))
+
+    assert version_bumper.get_new_version("click") == "8.1.0"
+    # The rest of the body is abandoned together with the connection.
+    assert pypi.closed == 1
+
+
+@pytest.mark.parametrize(
+    "content,expected",
+    [
+        ("not json", {}),
+        ("[1, 2]", {}),
+        (
+            json.dumps(
+                {
+                    "a": 1,
+                    "b": {"etag": "x"},
+                    "c": {"etag": "e", "version": 2},
+                    "d": {"etag": "e", "version": "1.0"},
+                },
+            ),
+            {"d": {"etag": "e", "version": "1.0"}},
+        ),
+    ],
+)
+def test_load_etag_cache(
+    pypi: FakePyPI,
+    tmp_path: Path,
+    content: str,
+    expected: Dict[str, Dict[str, str]],
+) -> None:
+    (tmp_path / "etags.json").write_text(content)
+
+    version_bumper.load_etag_cache()
+
+    assert version_bumper._ETAG_CACHE == expected
+
+
+def test_etag_cache_without_home(
+    pypi: FakePyPI,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(version_bumper, "get_etag_cache_path", lambda: None)
+    version_bumper._ETAG_CACHE["click"] = {"etag": "e", "version": "1.0"}
+
+    version_bumper.save_etag_cache()
+    version_bumper.load_etag_cache()
+
+    assert version_bumper._ETAG_CACHE == {"click": {"etag": "e", "version": "1.0"}}
+
+
+def test_main(
+    pypi: FakePyPI,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    pyproject = tmp_path / "pyproject.toml"
+    pyproject.write_text(
+        "[tool.poetry.dependencies]\n"
+        'python = "^3.8"\n'
+        'click = "^8.0"\n'
+        'typer = {version = "^0.7.0", extras = ["all"]}\n'
+        'broken = "^1.0"\n'
+        'frozen = "==1.0"\n'
+        "\n"
+        "[tool.poetry.dev-dependencies]\n"
+        'click = "^7.0"\n',
+    )
+    pypi.add("click", 200, package_json("8.1.0"), {"ETag": '"c"'})
+    pypi.add("typer", 200, package_json("0.9.0"))
+    pypi.add("broken", 200, b"<html>oops</html>")
+    monkeypatch.setattr(sys, "argv", ["version_bumper", str(pyproject)])
+    # The cache can't be saved under a regular file.
+    (tmp_path / "file").touch()
+    monkeypatch.setattr(
+        version_bumper,
+        "get_etag_cache_path",
+        lambda: tmp_path / "file" / "etags.json",
+    )
+
+    version_bumper.main()
+
+    assert pyproject.read_text() == (
+        "[tool.poetry.dependencies]\n"
+        'python = "^3.8"\n'
+        'click = "^8.1.0"\n'
+        'typer = {version = "^0.9.0", extras = ["all"]}\n'
+        'broken = "^1.0"\n'
+        'frozen = "==1.0"\n'
+        "\n"
+        "[tool.poetry.dev-dependencies]\n"
+        'click = "^7.0"\n'
+    )
+    assert sorted(path for path, _ in pypi.requests) == [
+        "/pypi/broken/json",
+        "/pypi/click/json",
+        "/pypi/typer/json",
+    ]
@@ -1,13 +1,83 @@
 import argparse
+import base64
+import gzip
+import http.client
+import json
+import logging
+import os
+import ssl
+import threading
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
 import re
-import requests
+from packaging.utils import canonicalize_name
+from packaging.version import InvalidVersion, Version
 
-RAW_VERSION_RE = re.compile(r'(?P<package>.*)\s*=\s*\"(?P<version>[\^\~\>\=\<\!]?[\d\.\-\w]+)\"')
-EXPANDED_VER_RE = re.compile(
-    r'(?P<package>.*)\s*=\s*\{(.*)version\s*=\s*\"(?P<version>[\^\~\>\=\<\!]?[\d\.\-\w]+)\"(.*)\}'
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+# Errors a single lookup may fail with: network and protocol errors,
+# and bodies that aren't the expected JSON document.
+LOOKUP_ERRORS: Tuple[type, ...] = (
+    OSError,
+    EOFError,
+    zlib.error,
+    http.client.HTTPException,
+    ValueError,
+    KeyError,
+    TypeError,
 )
+if ijson is not None:
+    LOOKUP_ERRORS += (ijson.JSONError,)
+
+# Characters of version specifiers that precede the version itself.
+SPEC_CHARS = "^=!~<>"
+
+# Groups: 1 - package, 2 - version in an expanded table, 3 - raw version.
+DEPENDENCY_RE = re.compile(
+    r'\s*(?P<package>[^\s=]+)\s*=\s*(?:'
+    r'\{(?:[^}]*,)?\s*version\s*=\s*\"(?P<expanded>[\^\~\>\<\!]?[\d\.\-\w]+)\"[^}]*\}'
+    r'|\"(?P<raw>[\^\~\>\<\!]?[\d\.\-\w]+)\"'
+    r')'
+)
+
+logger = logging.getLogger("version_bumper")
+
+# Lines inside a dependency section that aren't dependencies to bump.
+SKIP_LINE_RE = re.compile(r'python\s*=|\{%')
+
+# Number of concurrent PyPI lookups.
+MAX_WORKERS = 20
+
+# Bodies at least this large (in bytes on the wire) are parsed incrementally
+# with ijson and abandoned once the version is read. That costs the
+# connection, so smaller bodies are read in full to keep it alive.
+STREAM_MIN_LENGTH = 64 * 1024
+
+PYPI_HOST = "pypi.org"
+
+# Every worker thread keeps its own keep-alive connection to PyPI.
+_LOCAL = threading.local()
+
+# package name -> {"etag": ..., "version": ...} from previous runs.
+_ETAG_CACHE: Dict[str, Dict[str, str]] = {}
 
 def parse_args() -> argparse.Namespace:
     """
@@ -21,7 +91,7 @@ def parse_args() -> argparse.Namespace:
 
     Examples:
         >>> parse_args()
-        Namespace(file=Path(''), section='tool.poetry.dependencies')
+        Namespace(file=Path(''), section='tool.poetry.dependencies', verbose=False)
 
     """
 
@@ -36,30 +106,227 @@ def parse_args() -> argparse.Namespace:
         type=str,
         default="tool.poetry.dependencies",
     )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="store_true",
+    )
     output = parser.parse_args()
     if output is None:
         return None
     return output
 
-def get_dependencies(path: Path, section: str) -> List[str]:
-    read_file = path.read_text()
+def get_dependencies(path: Path, section: str) -> Tuple[List[str], List[Tuple[int, str]]]:
+    lines = []
     recording = False
     deps = []
-    for index, line in enumerate(read_file.splitlines(keepends=False)):
-        if line.startswith('[') and line.strip('[]') != section:
-            recording = False
-            continue
-        if line == f"[{section}]":
-            recording = True
-            continue
-        if line.startswith('python ='):
-            continue
-        if line.startswith('{%'):
-            continue
-        if recording:
-            deps.append((index, line))
-    return deps
+    section_header = f"[{section}]"
+    skip_line = SKIP_LINE_RE.match
+    with path.open("r", encoding="utf-8") as file:
+        for index, line in enumerate(file):
+            line = line.rstrip("\n")
+            lines.append(line)
+            if line.startswith('['):
+                recording = line == section_header
+                continue
+            if recording and not skip_line(line):
+                deps.append((index, line))
+    return lines, deps
+
+def get_etag_cache_path() -> Optional[Path]:
+    """
+    Get the location of the ETag cache.
+
+    Returns:
+        Optional[Path]: The path to the cache file, or None if there's
+            no home directory to keep it in.
+    """
+
+    try:
+        home = Path.home()
+    except (RuntimeError, KeyError):
+        return None
+    # Before Python 3.12 an unknown home directory is returned as "~".
+    if not home.is_absolute():
+        return None
+    return home / ".cache" / "version_bumper" / "etags.json"
+
+def load_etag_cache(path: Optional[Path] = None) -> None:
+    """
+    Load ETags and versions stored by previous runs.
+
+    A missing or unreadable cache file is treated as an empty cache,
+    and malformed entries are ignored.
 
+    Args:
+        path (Optional[Path]): The path to the cache file,
+            `get_etag_cache_path()` by default.
+    """
+
+    if path is None:
+        path = get_etag_cache_path()
+    if path is None:
+        return
+    try:
+        data = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return
+    if not isinstance(data, dict):
+        return
+    for package, entry in data.items():
+        if (
+            isinstance(entry, dict)
+            and isinstance(entry.get("etag"), str)
+            and isinstance(entry.get("version"), str)
+        ):
+            _ETAG_CACHE[package] = entry
+
+def save_etag_cache(path: Optional[Path] = None) -> None:
+    """
+    Store ETags and versions for the next run.
+
+    Failing to write the cache isn't fatal, the next run
+    just queries PyPI without conditional requests.
+
+    Args:
+        path (Optional[Path]): The path to the cache file,
+            `get_etag_cache_path()` by default.
+    """
+
+    if path is None:
+        path = get_etag_cache_path()
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(_ETAG_CACHE))
+    except OSError as exc:
+        logger.warning("Can't save ETag cache to %s: %s", path, exc)
+
+def get_ca_file() -> Optional[str]:
+    """
+    Get the CA bundle to verify PyPI's certificate with.
+
+    Like requests, REQUESTS_CA_BUNDLE and CURL_CA_BUNDLE are honored,
+    then certifi's bundle if it's installed. Otherwise the system
+    certificates are used.
+
+    Returns:
+        Optional[str]: The path to the CA bundle, or None for the system default.
+    """
+
+    ca_file = os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE")
+    if ca_file:
+        return ca_file
+    if certifi is not None:
+        return certifi.where()
+    return None
+
+def create_connection() -> http.client.HTTPSConnection:
+    """
+    Create a connection to PyPI.
+
+    HTTPS_PROXY and NO_PROXY are honored: through a proxy the connection
+    is tunneled with CONNECT, using credentials from the proxy URL.
+
+    Returns:
+        http.client.HTTPSConnection: The new, not yet connected, connection.
+    """
+
+    context = ssl.create_default_context(cafile=get_ca_file())
+    proxy = urllib.request.getproxies().get("https")
+    if not proxy or urllib.request.proxy_bypass(PYPI_HOST):
+        return http.client.HTTPSConnection(PYPI_HOST, timeout=10, context=context)
+    if "://" not in proxy:
+        proxy = f"http://{proxy}"
+    proxy_url = urlsplit(proxy)
+    conn = http.client.HTTPSConnection(
+        proxy_url.hostname,
+        proxy_url.port or 80,
+        timeout=10,
+        context=context,
+    )
+    tunnel_headers = {}
+    if proxy_url.username:
+        credentials = f"{unquote(proxy_url.username)}:{unquote(proxy_url.password or '')}"
+        tunnel_headers["Proxy-Authorization"] = (
+            f"Basic {base64.b64encode(credentials.encode()).decode()}"
+        )
+    conn.set_tunnel(PYPI_HOST, 443, headers=tunnel_headers)
+    return conn
+
+def get_connection() -> http.client.HTTPSConnection:
+    """
+    Get the PyPI connection of the current thread.
+
+    The connection is kept alive between lookups, unless a response
+    body was abandoned half-read (see `read_version`). In that case it's
+    closed and reopened with a new TLS handshake on the next request.
+
+    Returns:
+        http.client.HTTPSConnection: The connection, created on first use.
+    """
+
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        conn = create_connection()
+        _LOCAL.conn = conn
+    return conn
+
+def request_package(package_name: str, headers: Dict[str, str]) -> http.client.HTTPResponse:
+    """
+    Request the JSON metadata of a package from PyPI.
+
+    The name is canonicalized first, since PyPI redirects
+    non-canonical names and http.client doesn't follow redirects.
+
+    Args:
+        package_name (str): The name of the package.
+        headers (Dict[str, str]): Headers to send with the request.
+
+    Returns:
+        http.client.HTTPResponse: The response, with the body not read yet.
+    """
+
+    path = f"/pypi/{canonicalize_name(package_name)}/json"
+    conn = get_connection()
+    try:
+        conn.request("GET", path, headers=headers)
+        return conn.getresponse()
+    except (ConnectionResetError, BrokenPipeError):
+        # PyPI may drop an idle keep-alive connection, retry on a fresh one.
+        conn.close()
+        conn.request("GET", path, headers=headers)
+        return conn.getresponse()
+
+def read_version(resp: http.client.HTTPResponse) -> Optional[str]:
+    """
+    Extract the latest version from a PyPI JSON response.
+
+    Gzip-encoded bodies are decompressed while they are read.
+    If ijson is installed and the body is at least STREAM_MIN_LENGTH
+    bytes, it's parsed incrementally and reading stops as soon as
+    `info.version` is seen, which skips the release history of heavy
+    packages. The rest of the body is never read, so the connection
+    can't be reused. Other bodies are decoded in full, keeping the
+    connection alive.
+
+    Args:
+        resp (http.client.HTTPResponse): A response with the body not read yet.
+
+    Returns:
+        Optional[str]: The latest version, or None if it wasn't found.
+    """
+
+    body = resp
+    if resp.getheader("Content-Encoding") == "gzip":
+        body = gzip.GzipFile(fileobj=resp)
+    length = resp.getheader("Content-Length", "")
+    if ijson is None or not length.isdigit() or int(length) < STREAM_MIN_LENGTH:
+        return json_loads(body.read())['info']["version"]
+    return next(ijson.items(body, "info.version"), None)
+
+@lru_cache(maxsize=1024)
 def get_new_version(package_name: str) -> Optional[str]:
     """
     This function retrieves the latest version of a given package from the PyPI repository.
@@ -69,6 +336,9 @@ def get_new_version(package_name: str) -> Optional[str]:
 
     Returns:
         Optional[str]: The latest version of the package, or None if an error occurred.
+            Results are cached for the lifetime of the process. If PyPI reports
+            that the package is unchanged since the last run, the version
+            stored in the ETag cache is returned without downloading the body.
 
     Raises:
         None: This function does not raise any exceptions.
@@ -78,92 +348,160 @@ def get_new_version(package_name: str) -> Optional[str]:
         '2.26.0'
     """
 
-    resp = requests.get(f'https://pypi.org/pypi/{package_name}/json')
-    if not resp.ok:
+    logger.info("Checking %s", package_name)
+    cached = _ETAG_CACHE.get(package_name)
+    headers = {"Accept": "application/json", "Accept-Encoding": "gzip"}
+    if cached:
+        headers["If-None-Match"] = cached["etag"]
+    try:
+        resp = request_package(package_name, headers)
+        if resp.status != 200:
+            # Drain the body so the connection can be reused.
+            resp.read()
+            if cached and resp.status == 304:
+                return cached["version"]
+            return None
+        version = read_version(resp)
+        if not isinstance(version, str):
+            raise TypeError(f"unexpected version {version!r}")
+        etag = resp.getheader("ETag")
+        if not resp.isclosed():
+            # The body was left unread, so the connection can't be reused.
+            get_connection().close()
+    except LOOKUP_ERRORS as exc:
+        # One failed lookup shouldn't abort the whole run.
+        get_connection().close()
+        logger.warning("Can't check %s: %s", package_name, exc)
         return None
-    rjson = resp.json()
-    return rjson['info']["version"]
+    if etag:
+        _ETAG_CACHE[package_name] = {"etag": etag, "version": version}
+    return version
 
 
-def bump_version(dependency: str) -> str:
+def is_newer(version: str, new_version: str) -> bool:
     """
-    This function is used to bump the version of a dependency in a given string.
+    Check whether a version from PyPI is newer than the current one.
+
+    Versions are compared as PEP 440 versions, so "1.10" and "1.10.0"
+    are equal and yanked-release downgrades are ignored. Versions that
+    can't be parsed are compared as strings.
 
     Args:
-        dependency (str): The string representation of the dependency.
+        version (str): The version currently specified.
+        new_version (str): The latest version on PyPI.
 
     Returns:
-        str: The updated string with the bumped version, or None if no update is needed.
+        bool: True if the dependency should be bumped.
+    """
 
-    Raises:
-        None
+    try:
+        return Version(new_version) > Version(version)
+    except InvalidVersion:
+        return version != new_version
+
+def parse_dependency(dependency: str) -> Optional[Tuple[str, str, int, int]]:
+    """
+    Parse a dependency line into the package name and its version.
+
+    Args:
+        dependency (str): The string representation of the dependency.
+
+    Returns:
+        Optional[Tuple[str, str, int, int]]: The package name, the version
+            without specifiers and the span of the version in the line,
+            or None if the line shouldn't be bumped.
 
     Example:
-        >>> bump_version("^requests==2.25.0")
-        Checking requests
-        Found new version: 2.26.0
-        '^requests==2.26.0'
+        >>> parse_dependency('requests = "^2.25.0"')
+        ('requests', '2.25.0', 13, 19)
 
     Note:
-        - The function expects the dependency string to be in a specific format.
-        - The function uses regular expressions to extract the package name and version.
-        - The function calls the 'get_new_version' function to retrieve the latest version of the package.
-    """
-
-    exp_match = EXPANDED_VER_RE.match(dependency)
-    raw_match = None
-    if exp_match:
-        package = exp_match.group("package").strip()
-        version = exp_match.group("version").lstrip("^=!~<>")
-    else:
-        raw_match = RAW_VERSION_RE.match(dependency)
-    if raw_match:
-        package = raw_match.group("package").strip()
-        version = raw_match.group("version").lstrip("^=!~<>")
-    if exp_match is None and raw_match is None:
+        - Only a single specifier character other than '=' is allowed
+          before the version, so exact '=' and '==' pins and ranges like
+          '>=' or '!=' never match. They are left untouched and PyPI
+          isn't queried for them.
+    """
+
+    match = DEPENDENCY_RE.match(dependency)
+    if match is None:
         return None
+    package = match.group(1)
+    # Only one of the alternatives matches, so it's the last group.
+    group = match.lastindex
+    version = match.group(group).lstrip(SPEC_CHARS)
+    end = match.end(group)
+    return package, version, end - len(version), end
 
-    print(f"Checking {package}")
-    new_version = get_new_version(package)
-    if new_version is not None and version != new_version:
-        print(f"Found new version: {new_version}")
-        return dependency.replace(version, new_version)
+def get_new_versions(packages: List[str]) -> List[Optional[str]]:
+    """
+    Retrieve the latest versions of all given packages concurrently.
 
-    return None
+    Every PyPI lookup is a blocking network call, so packages
+    are looked up in a thread pool.
+
+    Args:
+        packages (List[str]): The names of the packages.
+
+    Returns:
+        List[Optional[str]]: The latest versions in the same order,
+            None for packages that couldn't be looked up.
+    """
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(get_new_version, packages))
 
 def main():
     """
     Main function to update dependencies in a file.
 
+    Every dependency line is parsed once. The new versions are then
+    spliced into the remembered spans without parsing the lines again.
+
     Args:
         file (str): The path to the file containing the dependencies.
         section (str): The section of the file where the dependencies are located.
 
     Raises:
         FileNotFoundError: If the specified file does not exist.
-        ValueError: If the specified section does not exist in the file.
 
     Example:
         >>> args = parse_args()
-        >>> deps = get_dependencies(args.file, args.section)
-        >>> lines = args.file.read_text().splitlines(keepends=False)
-        >>> for i, dep in deps:
-        ...     new_version = bump_version(dep)
-        ...     if new_version:
-        ...         lines[i] = new_version
-        >>> args.file.write_text("\n".join(lines))
+        >>> lines, deps = get_dependencies(args.file, args.section)
+        >>> parsed = [(i, parse_dependency(dep)) for i, dep in deps]
+        >>> parsed = [(i, *dep) for i, dep in parsed if dep is not None]
+        >>> packages = list(dict.fromkeys(package for _, package, *_ in parsed))
+        >>> new_versions = dict(zip(packages, get_new_versions(packages)))
+        >>> for i, package, version, start, end in parsed:
+        ...     new_version = new_versions[package]
+        ...     if new_version is not None and is_newer(version, new_version):
+        ...         lines[i] = lines[i][:start] + new_version + lines[i][end:]
+        >>> with args.file.open("w", encoding="utf-8", newline="\n") as file:
+        ...     file.writelines(f"{line}\n" for line in lines)
     """
 
     args = parse_args()
-    deps = get_dependencies(args.file, args.section)
-    lines = args.file.read_text().splitlines(keepends=False)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(message)s",
+    )
+    lines, deps = get_dependencies(args.file, args.section)
+    parsed = []
     for i, dep in deps:
-        new_version = bump_version(dep)
-        if new_version:
-            lines[i] = new_version
-    args.file.write_text("\n".join(lines))
-    
-
+        dependency = parse_dependency(dep)
+        if dependency is not None:
+            parsed.append((i, *dependency))
+    load_etag_cache()
+    # Lookups run concurrently, so lru_cache can't merge duplicates in flight.
+    packages = list(dict.fromkeys(package for _, package, *_ in parsed))
+    new_versions = dict(zip(packages, get_new_versions(packages)))
+    for i, package, version, start, end in parsed:
+        new_version = new_versions[package]
+        if new_version is not None and is_newer(version, new_version):
+            logger.info("Found new version for %s: %s", package, new_version)
+            lines[i] = lines[i][:start] + new_version + lines[i][end:]
+    with args.file.open("w", encoding="utf-8", newline="\n") as file:
+        file.writelines(f"{line}\n" for line in lines)
+    save_etag_cache()
 
 if __name__ == "__main__":
     main()